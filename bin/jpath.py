@@ -1,14 +1,27 @@
 import json
 import re
 import sys
+from functools import lru_cache
 
 import splunk.Intersplunk as si
 
 ERROR_FIELD = "_jmespath_error"
 
+FIELDNAME_INVALID_CHARS = re.compile(r'[^A-Za-z0-9_.{}\[\]]')
+
+CONTAINER_TYPES = (list, tuple, dict)
+
+# Characters a JSON document may start with (objects, arrays, strings, numbers, true/false/null,
+# plus the NaN/Infinity extensions accepted by the json module)
+JSON_WHITESPACE = " \t\n\r"
+JSON_START_CHARS = frozenset('{["-0123456789tfnNI')
+
+# Sentinel for missing keys, since None is a legitimate JSON value
+_MISSING = object()
+
 import jmespath
 from six import string_types, text_type
-from jmespath import functions
+from jmespath import functions, visitor
 from jmespath.exceptions import ParseError, JMESPathError, UnknownFunctionError
 
 
@@ -19,7 +32,7 @@ class JmesPathSplunkExtraFunctions(functions.Functions):
     def _func_items(self, h):
         """ JMESPath includes a keys() and a values(), but with unordered objects, there's no way
         to line these up!  So this feels like an pretty obvious extension to a Python guy! """
-        return [list(item) for item in h.items()]
+        return [[k, v] for k, v in h.items()]
 
     @functions.signature({'types': ['array']})
     def _func_to_hash(self, array):
@@ -28,11 +41,12 @@ class JmesPathSplunkExtraFunctions(functions.Functions):
         """
         h = {}
         for item in array:
-            try:
-                key, val = item
-                h[key] = val
-            except Exception:
-                pass
+            if isinstance(item, list) and len(item) == 2:
+                try:
+                    h[item[0]] = item[1]
+                except TypeError:
+                    # Unhashable key (array or object); skip it
+                    pass
         return h
 
     @functions.signature({'types': ['string', 'array']})
@@ -68,8 +82,11 @@ class JmesPathSplunkExtraFunctions(functions.Functions):
         d = dict()
         for item in objs:
             try:
-                k = item[key]
-                v = item[value]
+                k = item.get(key, _MISSING)
+                v = item.get(value, _MISSING)
+                if k is _MISSING or v is _MISSING:
+                    # If either field is missing, just silently move on
+                    continue
                 if not isinstance(k, string_types):
                     k = text_type(k)
                 k = sanitize_fieldname(k)
@@ -82,9 +99,6 @@ class JmesPathSplunkExtraFunctions(functions.Functions):
                     if not isinstance(d[k], list):
                         d[k] = [ d[k] ]
                     d[k].append(v)
-            except KeyError:
-                # If either field is missing, just silently move on
-                continue
             except NameError:
                 raise
             except Exception as e:
@@ -96,9 +110,14 @@ class JmesPathSplunkExtraFunctions(functions.Functions):
 jp_options = jmespath.Options(custom_functions=JmesPathSplunkExtraFunctions())
 
 
+# A single reusable decoder; json.loads() re-checks its arguments on every call
+json_loads = json.JSONDecoder().decode
+
+
+@lru_cache(maxsize=4096)
 def sanitize_fieldname(field):
-    # XXX: Add caching, if needed
-    clean = re.sub(r'[^A-Za-z0-9_.{}\[\]]', "_", field)
+    # Cached since unroll() and wildcard output see the same handful of keys on every event
+    clean = FIELDNAME_INVALID_CHARS.sub("_", field)
     # Remove leading/trailing underscores
     # It would be nice to preserve explicit underscores but don't want to complicate the code for
     # a not-yet-existing corner case.  Generally it's better to avoid hidden fields.
@@ -110,9 +129,10 @@ def flatten(container):
     if isinstance(container, dict):
         yield json.dumps(container)
     elif isinstance(container, (list,tuple)):
+        dumps = json.dumps
         for i in container:
-            if isinstance(i, (list,tuple,dict)):
-                yield json.dumps(i)
+            if isinstance(i, CONTAINER_TYPES):
+                yield dumps(i)
             else:
                 yield text_type(i)
     else:
@@ -120,42 +140,79 @@ def flatten(container):
 
 
 def output_to_field(values, output, record):
-    content = list(flatten(values))
-    if not content:
-        content = None
-        record[output] = None
-    elif len(content) == 1:
-        # Avoid the overhead of MV field encoding
-        content = content[0]
+    # Only go through flatten() when there's more than one value; everything else maps straight
+    # to a single string without building a temporary list.  Scalars are by far the most common
+    # result, so they are checked first.
+    if not isinstance(values, CONTAINER_TYPES):
+        content = text_type(values)
+    elif isinstance(values, dict):
+        content = json.dumps(values)
+    else:
+        if not values:
+            content = None
+        elif len(values) == 1:
+            # Avoid the overhead of MV field encoding
+            value = values[0]
+            if isinstance(value, CONTAINER_TYPES):
+                content = json.dumps(value)
+            else:
+                content = text_type(value)
+        else:
+            content = list(flatten(values))
     record[output] = content
 
 
+def _wildcard_array(value):
+    if not value:
+        return None
+    elif len(value) == 1:
+        # Unroll, to better match Splunk's default handling of mvfields
+        return value[0]
+    return json.dumps(value)
+
+
+# Per-type conversion for wildcard output values; None means store the value as-is.  Filled in
+# lazily by wildcard_converter() for any other type seen (scalars, subclasses like OrderedDict).
+WILDCARD_CONVERTERS = {
+    list: _wildcard_array,
+    tuple: _wildcard_array,
+    dict: json.dumps,
+}
+
+
+def wildcard_converter(cls):
+    if issubclass(cls, (list, tuple)):
+        converter = _wildcard_array
+    elif issubclass(cls, dict):
+        converter = json.dumps
+    else:
+        converter = None
+    WILDCARD_CONVERTERS[cls] = converter
+    return converter
+
+
 def output_to_wildcard(values, output, record):
-    output_template = output.replace("*", "{}", 1)
+    # Split the template once, rather than substituting '*' for every key
+    prefix, _, suffix = output.partition("*")
     if values is None:
         # Don't bother to make any fields
         return
 
     if isinstance(values, dict):
+        converters = WILDCARD_CONVERTERS
         for (key, value) in values.items():
-            final_field = output_template.format(sanitize_fieldname(key))
-            if isinstance(value, (list, tuple)):
-                if not value:
-                    value = None
-                elif len(value) == 1:
-                    # Unroll, to better match Splunk's default handling of mvfields
-                    value = value[0]
-                else:
-                    value = json.dumps(value)
-                record[final_field] = value
-            elif isinstance(value, dict):
-                record[final_field] = json.dumps(value)
-            else:
-                record[final_field] = value
+            final_field = prefix + sanitize_fieldname(key) + suffix
+            cls = type(value)
+            converter = converters.get(cls, _MISSING)
+            if converter is _MISSING:
+                converter = wildcard_converter(cls)
+            if converter is not None:
+                value = converter(value)
+            record[final_field] = value
     else:
         # Fallback to using a silly name since there's no hash key to work with.
         # (Maybe users didn't mean to use '*' in output, or possibly a record/data specific issue
-        final_field = output_template.format("anonymous")
+        final_field = prefix + "anonymous" + suffix
         record[final_field] = json.dumps(values)
 
 
@@ -201,6 +258,15 @@ def jpath():
             sys.exit(0)
 
         results, dummyresults, settings = si.getOrganizedResults()
+        # Bind per-result lookups to locals once, instead of on every iteration.  jp.search()
+        # builds a fresh TreeInterpreter per call; the interpreter holds no per-search state, so
+        # share one across all results.
+        visit = visitor.TreeInterpreter(jp_options).visit
+        parsed = jp.parsed
+        loads = json_loads
+        error_field = ERROR_FIELD
+        json_whitespace = JSON_WHITESPACE
+        json_start_chars = JSON_START_CHARS
         # for each results
         for result in results:
             # get field value
@@ -210,15 +276,19 @@ def jpath():
                 if isinstance(ojson, (list, tuple)):
                     # XXX: Add proper support for multivalue input fields.  Just use first value for now
                     ojson = ojson[0]
+                if ojson.lstrip(json_whitespace)[:1] not in json_start_chars:
+                    # Obviously not JSON (plain text events, etc.).  Skip without paying for the
+                    # parser and its exception.
+                    continue
                 try:
-                    json_obj = json.loads(ojson)
+                    json_obj = loads(ojson)
                 except ValueError:
                     # Invalid JSON.  Move on, nothing to see here.
                     continue
                 try:
-                    values = jp.search(json_obj, options=jp_options)
+                    values = visit(parsed, json_obj)
                     apply_output(values, fn_output, result)
-                    result[ERROR_FIELD] = None
+                    result[error_field] = None
                     added = True
                 except UnknownFunctionError as e:
                     # Can't detect invalid function names during the compile, but we want to treat
@@ -227,9 +297,9 @@ def jpath():
                     sys.exit(0)
                 except JMESPathError as e:
                     # Not 100% sure I understand what these errors mean. Should they halt?
-                    result[ERROR_FIELD] = "JMESPath error: {}".format(e)
+                    result[error_field] = "JMESPath error: {}".format(e)
                 except Exception as e:
-                    result[ERROR_FIELD] = "Exception: {}".format(e)
+                    result[error_field] = "Exception: {}".format(e)
 
             if not added and defaultval is not None:
                 result[fn_output] = defaultval